@@ -2,12 +2,17 @@
 
 from flask import Flask
 from database import init_db
+from cache import init_answer_cache
+from gtfs_processor import init_gtfs_meta
 from routes import index, execute_query, chat, upload_file, get_available_models
 
 app = Flask(__name__)
+app.config.from_object('config')
 
 # Initialize the database
 init_db()
+init_answer_cache()
+init_gtfs_meta()
 
 # Register routes
 app.add_url_rule('/', view_func=index)
@@ -17,4 +22,8 @@ app.add_url_rule('/chat', view_func=chat, methods=['POST'])
 app.add_url_rule('/get_available_models', view_func=get_available_models)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Development server only. In production run a single threaded worker, e.g.
+    #   gunicorn -k gthread -w 1 --threads 16 -b 0.0.0.0:5000 app:app
+    # The schema cache and query engine live in process memory and an upload only resets
+    # them in the process that handled it, so extra workers would keep the previous feed's schema
+    app.run(debug=app.config['DEBUG'], host='0.0.0.0', port=5000)
\ No newline at end of file
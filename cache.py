@@ -0,0 +1,114 @@
+# cache.py
+
+from collections import OrderedDict
+from functools import wraps
+from database import execute_query, query_to_dict
+import hashlib
+import json
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize(text):
+    # Collapse whitespace so trivially different prompts share an entry. Case is kept:
+    # GTFS ids, names and SQL string literals are case-sensitive
+    return _WHITESPACE.sub(' ', text).strip()
+
+class LRUCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+def llm_cache_key(system_prompt, messages, client_name="anthropic", model=None, max_tokens=1000):
+    message_key = tuple(
+        (message['role'], normalize(message['content'][0]['text']))
+        for message in messages
+    )
+    return (normalize(system_prompt), message_key, client_name, model, max_tokens)
+
+def memoize(key_fn, maxsize=1024):
+    """Memoize a function on a normalized key; only safe for deterministic (temperature=0) calls."""
+    def decorator(func):
+        cache = LRUCache(maxsize)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = key_fn(*args, **kwargs)
+            result = cache.get(key)
+            if result is None:
+                result = func(*args, **kwargs)
+                cache.set(key, result)
+            return result
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+# Answers to previously seen conversations, stored alongside the feed and cleared on ingest
+QA_CACHE_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS qa_cache (
+        question TEXT,  -- sha256 of the conversation; the full text can outgrow a btree entry
+        company_model TEXT,
+        sql TEXT,
+        result_json JSONB,
+        summary TEXT,
+        PRIMARY KEY (question, company_model)
+    )
+"""
+
+def init_answer_cache():
+    execute_query(QA_CACHE_TABLE_QUERY)
+
+def conversation_key(messages):
+    conversation = '\n'.join(f"{message['role']}: {normalize(message['content'][0]['text'])}" for message in messages)
+    return hashlib.sha256(conversation.encode('utf-8')).hexdigest()
+
+def lookup_answer(messages, company, model):
+    rows = query_to_dict(
+        "SELECT sql, result_json, summary FROM qa_cache WHERE question = %s AND company_model = %s",
+        (conversation_key(messages), f"{company} - {model}")
+    )
+    if not rows:
+        return None
+    return rows[0]['summary'], rows[0]['result_json'], rows[0]['sql']
+
+def store_answer(messages, company, model, summary, results, query, encoder=None):
+    # The answer has already been computed; failing to cache it must not fail the request
+    try:
+        execute_query(
+            """
+            INSERT INTO qa_cache (question, company_model, sql, result_json, summary)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (question, company_model)
+            DO UPDATE SET sql = EXCLUDED.sql, result_json = EXCLUDED.result_json, summary = EXCLUDED.summary
+            """,
+            (conversation_key(messages), f"{company} - {model}", query, json.dumps(results, cls=encoder), summary)
+        )
+    except Exception:
+        logger.exception("Failed to cache answer")
+
+def clear_answers():
+    execute_query("TRUNCATE qa_cache")
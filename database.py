@@ -1,67 +1,130 @@
 import psycopg2
 from psycopg2 import sql
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from contextlib import contextmanager
+import threading
 import time
 
-# Global connection variable
-conn = None
+# Global connection pool, created on first use
+pool = None
+pool_lock = threading.Lock()
+min_connections = 2
+max_connections = 16
 max_retries = 3
 retry_delay = 5  # seconds
 
+# getconn() raises PoolError instead of waiting when every connection is checked out,
+# so callers queue here for a free one
+connection_slots = threading.BoundedSemaphore(max_connections)
+
+class GTFSConnection(psycopg2.extensions.connection):
+    # Set once the per-session PostGIS setup has run on this connection
+    initialized = False
+
+def get_pool():
+    global pool
+
+    # Every checkout goes through here, so skip the lock once the pool exists
+    if pool is not None and not pool.closed:
+        return pool
+
+    with pool_lock:
+        if pool is None or pool.closed:
+            pool = ThreadedConnectionPool(
+                min_connections,
+                max_connections,
+                dbname="postgres",
+                user="postgres",
+                password="mysecretpassword",
+                host="localhost",
+                port="5432",
+                connection_factory=GTFSConnection
+            )
+    return pool
+
 def get_db_connection():
-    global conn
-    
+    """Check a connection out of the pool, waiting for one if all are in use; hand it back with release_db_connection()."""
+    connection_slots.acquire()
+    try:
+        return checkout_connection()
+    except BaseException:
+        connection_slots.release()
+        raise
+
+def checkout_connection():
     for attempt in range(max_retries):
         try:
-            if conn is None or conn.closed:
-                # Connection is not established or has been closed
-                conn = psycopg2.connect(
-                    dbname="postgres",
-                    user="postgres",
-                    password="mysecretpassword",
-                    host="localhost",
-                    port="5432"
-                )
+            conn = get_pool().getconn()
+            while conn.closed:
+                # The server side went away; drop it from the pool and take another straight away
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+
+            try:
                 conn.autocommit = True
-                cursor = conn.cursor()
-                cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS spatial_ref_sys (LIKE spatial_ref_sys INCLUDING ALL)")
-                cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis")
-            else:
-                # Test the connection
-                cursor = conn.cursor()
-                cursor.execute("SELECT 1")
-                cursor.fetchone()
-                
+                if not conn.initialized:
+                    cursor = conn.cursor()
+                    cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS spatial_ref_sys (LIKE spatial_ref_sys INCLUDING ALL)")
+                    cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+                    conn.initialized = True
+            except BaseException:
+                # Never hand a half-initialized connection out, and don't leave it checked out either
+                pool.putconn(conn, close=True)
+                raise
+
             return conn
 
         except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
             if attempt < max_retries - 1:
                 print(f"Connection attempt {attempt + 1} failed. Retrying in {retry_delay} seconds...")
                 time.sleep(retry_delay)
-                conn = None  # Reset the connection to force a new connection attempt
             else:
                 print("Failed to establish a database connection after multiple attempts.")
                 raise
 
-    return conn
+def release_db_connection(conn):
+    try:
+        pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        connection_slots.release()
+
+@contextmanager
+def db_connection():
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        release_db_connection(conn)
 
 def init_db():
-    cursor = get_db_connection().cursor()
-    # PostGIS is already initialized when the extension is created
-    pass
+    with db_connection():
+        # PostGIS is already initialized when the extension is created
+        pass
+
+def run_statement(query, params, cursor_factory=None, fetch=False):
+    # psycopg2 only marks a connection closed once a statement on it fails, so after a server
+    # restart pooled connections are found dead here. Each dead one is dropped and the statement
+    # retried on another; every pooled connection can be stale, hence the bound
+    for attempt in range(max_connections + 1):
+        with db_connection() as conn:
+            try:
+                with conn.cursor(cursor_factory=cursor_factory) as cursor:
+                    if params:
+                        cursor.execute(query, params)
+                    else:
+                        cursor.execute(query)
+                    return cursor.fetchall() if fetch else None
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if not conn.closed or attempt == max_connections:
+                    raise
 
 def execute_query(query, params=None):
-    cursor = get_db_connection().cursor()
-    if params:
-        cursor.execute(query, params)
-    else:
-        cursor.execute(query)
-    return cursor
+    run_statement(query, params)
 
 def query_to_dict(query, params=None):
-    cursor = get_db_connection().cursor(cursor_factory=RealDictCursor)
-    if params:
-        cursor.execute(query, params)
-    else:
-        cursor.execute(query)
-    return cursor.fetchall()
+    return run_statement(query, params, cursor_factory=RealDictCursor, fetch=True)
+
+def explain_query(query):
+    """Plan a query without executing it; raises the database error if it is invalid."""
+    execute_query(sql.SQL("EXPLAIN {}").format(sql.SQL(query)))
@@ -1,12 +1,15 @@
-from functools import wraps
-from flask import jsonify, request
-from database import query_to_dict 
+from database import query_to_dict, explain_query
 from gtfs_processor import gtfs_schema
+from cache import memoize, llm_cache_key, lookup_answer, store_answer
 from decimal import Decimal
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+from itertools import islice
 import json
-
-import anthropic
-import groq
+import logging
+import os
+import threading
 
 from rich import print as rprint
 from rich.console import Console
@@ -108,25 +111,60 @@ Provide ONLY the modified SQL query. Do not include any explanations or comments
 """
 
 # Map of clients and their models
-LLM_CLIENTS = {
-    "anthropic": {
-        "client": anthropic.Anthropic(),
-        "models": ["claude-3-5-sonnet-20240620"]
-    },
-    "groq": {
-        "client": groq.Groq(),
-        "models": ["llama-3.1-70b-versatile", "llama-3.1-405b-reasoning"]
-    }
-}
+def build_llm_clients():
+    # Only import and construct the SDKs for providers that have an API key configured
+    clients = {}
+    if os.environ.get("ANTHROPIC_API_KEY"):
+        import anthropic
+        clients["anthropic"] = {
+            "client": anthropic.Anthropic(),
+            "models": ["claude-3-5-sonnet-20240620"]
+        }
+    if os.environ.get("GROQ_API_KEY"):
+        import groq
+        clients["groq"] = {
+            "client": groq.Groq(),
+            "models": ["llama-3.1-70b-versatile", "llama-3.1-405b-reasoning"]
+        }
+    return clients
+
+LLM_CLIENTS = build_llm_clients()
+
+logger = logging.getLogger(__name__)
+
+# Rich-rendered prompt/response dumps are expensive; only produce them when DEBUG_LLM=1
+DEBUG_LLM = os.environ.get("DEBUG_LLM") == "1"
+console = Console()
+
+# Shared pool for overlapping independent LLM round-trips
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# Seconds to wait on the selected provider before also asking the others for the SQL
+HEDGE_DELAY = 5
+
+def call_when_started(started, func, *args, **kwargs):
+    # Signals when an executor worker actually picks the call up
+    started.set()
+    return func(*args, **kwargs)
 
 class DecimalEncoder(json.JSONEncoder):
+    # INTERVAL and DATE columns come back from psycopg2 as timedelta and date
     def default(self, obj):
         if isinstance(obj, Decimal):
             return float(obj)
+        if isinstance(obj, timedelta):
+            # GTFS-style H:MM:SS, so times past midnight read 25:10:00 rather than "1 day, 1:10:00"
+            sign = '-' if obj < timedelta(0) else ''
+            minutes, seconds = divmod(abs(int(obj.total_seconds())), 60)
+            hours, minutes = divmod(minutes, 60)
+            return f"{sign}{hours:02d}:{minutes:02d}:{seconds:02d}"
+        if isinstance(obj, date):
+            return obj.isoformat()
         return super(DecimalEncoder, self).default(obj)
 
-def llm_call(system_prompt, messages, client_name="anthropic", model=None, max_tokens=1000):
-    console = Console()
+def log_llm_request(system_prompt, messages):
+    if not DEBUG_LLM:
+        return
 
     console.print(Panel(system_prompt, title="System Prompt", expand=False, border_style="cyan"))
 
@@ -139,6 +177,15 @@ def llm_call(system_prompt, messages, client_name="anthropic", model=None, max_t
 
     console.print(message_table)
 
+def log_llm_response(result, client_name, model):
+    if not DEBUG_LLM:
+        logger.info("llm_call", extra={"client": client_name, "model": model, "response_length": len(result)})
+        return
+
+    console.print(Panel(Syntax(result, "markdown", theme="monokai", line_numbers=True), 
+                        title=f"LLM Response ({client_name} - {model})", expand=False, border_style="green"))
+
+def resolve_llm_client(client_name, model):
     if client_name not in LLM_CLIENTS:
         raise ValueError(f"Unsupported client: {client_name}")
 
@@ -149,80 +196,189 @@ def llm_call(system_prompt, messages, client_name="anthropic", model=None, max_t
     elif model not in LLM_CLIENTS[client_name]["models"]:
         raise ValueError(f"Unsupported model for {client_name}: {model}")
 
+    return client, model
+
+def to_anthropic_system(system_prompt):
+    # Mark the system prompt (schema + guidelines) as cacheable so repeat turns reuse it;
+    # prompts below Anthropic's minimum cacheable length are simply sent uncached
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+def to_groq_messages(system_prompt, messages):
+    # Convert messages to Groq-compatible format
+    groq_messages = [{"role": "system", "content": system_prompt}]
+    for msg in messages:
+        groq_messages.append({
+            "role": msg["role"],
+            "content": msg["content"][0]["text"]  # Extract the text content
+        })
+    return groq_messages
+
+@memoize(key_fn=llm_cache_key)
+def llm_call(system_prompt, messages, client_name="anthropic", model=None, max_tokens=1000):
+    log_llm_request(system_prompt, messages)
+    client, model = resolve_llm_client(client_name, model)
+
     if client_name == "anthropic":
         response = client.messages.create(
             model=model,
             max_tokens=max_tokens,
             temperature=0,
-            system=system_prompt,
+            system=to_anthropic_system(system_prompt),
             messages=messages
         )
         result = response.content[0].text.strip()
     elif client_name == "groq":
-        # Convert messages to Groq-compatible format
-        groq_messages = [{"role": "system", "content": system_prompt}]
-        for msg in messages:
-            groq_messages.append({
-                "role": msg["role"],
-                "content": msg["content"][0]["text"]  # Extract the text content
-            })
-
         response = client.chat.completions.create(
             model=model,
             max_tokens=max_tokens,
             temperature=0,
-            messages=groq_messages
+            messages=to_groq_messages(system_prompt, messages)
         )
 
         result = response.choices[0].message.content.strip()
 
-    console.print(Panel(Syntax(result, "markdown", theme="monokai", line_numbers=True), 
-                        title=f"LLM Response ({client_name} - {model})", expand=False, border_style="green"))
+    log_llm_response(result, client_name, model)
 
     return result
 
+def llm_stream(system_prompt, messages, client_name="anthropic", model=None, max_tokens=1000):
+    """Like llm_call, but yields the response text chunk by chunk as it is generated."""
+    log_llm_request(system_prompt, messages)
+    client, model = resolve_llm_client(client_name, model)
+
+    chunks = []
+    if client_name == "anthropic":
+        with client.messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=0,
+            system=to_anthropic_system(system_prompt),
+            messages=messages
+        ) as stream:
+            for text in stream.text_stream:
+                chunks.append(text)
+                yield text
+    elif client_name == "groq":
+        stream = client.chat.completions.create(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=0,
+            messages=to_groq_messages(system_prompt, messages),
+            stream=True
+        )
+        for chunk in stream:
+            text = chunk.choices[0].delta.content
+            if text:
+                chunks.append(text)
+                yield text
+
+    log_llm_response(''.join(chunks).strip(), client_name, model)
+
+def plan_error(query):
+    """Return the database's error message if the query fails to plan, else None."""
+    try:
+        explain_query(query)
+        return None
+    except Exception as e:
+        print(f"Query failed to plan: {e}")
+        return str(e)
+
+def fill_schema(template, schema):
+    # Escape braces in the schema so the remaining placeholders can still be .format()ed
+    return template.replace('{schema}', schema.replace('{', '{{').replace('}', '}}'))
+
+@lru_cache(maxsize=4)
+def render_schema_prompts(schema):
+    """Render the schema-dependent prompts once per schema instead of on every call."""
+    return (
+        SQL_SYSTEM_PROMPT.format(schema=schema),
+        fill_schema(SQL_ERROR_CORRECTION_PROMPT, schema),
+        fill_schema(EMPTY_RESULTS_CORRECTION_PROMPT, schema)
+    )
+
 class GTFSQueryEngine:
     def __init__(self):
         self.schema = gtfs_schema()
-        self.sql_system_prompt = SQL_SYSTEM_PROMPT.format(schema=self.schema)
+        (
+            self.sql_system_prompt,
+            self.sql_error_correction_prompt,
+            self.empty_results_correction_prompt
+        ) = render_schema_prompts(self.schema)
         self.summary_system_prompt = SUMMARY_SYSTEM_PROMPT
         self.data_validation_prompt = DATA_VALIDATION_PROMPT
-        self.sql_error_correction_prompt = SQL_ERROR_CORRECTION_PROMPT
-        self.empty_results_correction_prompt = EMPTY_RESULTS_CORRECTION_PROMPT
 
     def generate_query(self, messages, company, model):
-        return llm_call(self.sql_system_prompt, messages, client_name=company, model=model)
+        started = threading.Event()
+        primary = LLM_EXECUTOR.submit(call_when_started, started, llm_call, self.sql_system_prompt, messages, client_name=company, model=model)
+        pending = {primary}
+        hedged = False
+
+        # The hedge delay counts from when the request is sent, not while it queues for a busy
+        # executor; otherwise load alone would trigger hedging and double the API calls
+        started.wait()
+
+        # Take the first response whose SQL the database can plan
+        fallback = None
+        while pending:
+            done, pending = wait(pending, timeout=None if hedged else HEDGE_DELAY, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    continue
+                query = future.result()
+                error_message = plan_error(query)
+                if error_message is None:
+                    for other in pending:
+                        other.cancel()
+                    return query, None
+                if fallback is None or future is primary:
+                    fallback = (query, error_message)
+
+            # If the selected provider is slow or has failed, hedge with the other providers' default models
+            if not hedged and (not done or (primary in done and primary.exception() is not None)):
+                hedged = True
+                for client_name in LLM_CLIENTS:
+                    if client_name != company:
+                        pending.add(LLM_EXECUTOR.submit(llm_call, self.sql_system_prompt, messages, client_name=client_name))
+
+        # Nothing planned cleanly; hand the best candidate and its error to the correction loop
+        return fallback if fallback is not None else (primary.result(), None)
 
     def correct_sql_error(self, query, error_message, company, model):
-        correction_prompt = self.sql_error_correction_prompt.format(query=query, error_message=error_message, schema=self.schema)
+        correction_prompt = self.sql_error_correction_prompt.format(query=query, error_message=error_message)
         return llm_call(correction_prompt, [{"role": "user", "content": [{"type": "text", "text": "Correct the SQL query."}]}], client_name=company, model=model)
 
     def correct_empty_results(self, query, company, model):
-        correction_prompt = self.empty_results_correction_prompt.format(query=query, schema=self.schema)
+        correction_prompt = self.empty_results_correction_prompt.format(query=query)
         return llm_call(correction_prompt, [{"role": "user", "content": [{"type": "text", "text": "Modify the query to potentially return results."}]}], client_name=company, model=model)
 
-    def execute_query_with_retries(self, query, company, model, max_retries=3):
+    def execute_query_with_retries(self, query, company, model, max_retries=3, error_message=None):
+        # A known error_message for the query (e.g. from planning it) skips running it
         for attempt in range(max_retries):
-            try:
-                results = query_to_dict(query)
-                if results:
-                    return results, query
-                else:
-                    print(f"Attempt {attempt + 1}: Query returned no results. Attempting to correct the query.")
-                    query = self.correct_empty_results(query, company, model)
-                    print(f"Corrected query for empty results: {query}")
-            except Exception as e:
-                error_message = str(e)
+            if error_message is None:
+                try:
+                    results = query_to_dict(query)
+                except Exception as e:
+                    error_message = str(e)
+
+            if error_message is not None:
                 print(f"Attempt {attempt + 1}: Error executing query: {error_message}")
                 query = self.correct_sql_error(query, error_message, company, model)
                 print(f"Corrected query: {query}")
+                error_message = None
+            elif results:
+                return results, query
+            else:
+                print(f"Attempt {attempt + 1}: Query returned no results. Attempting to correct the query.")
+                query = self.correct_empty_results(query, company, model)
+                print(f"Corrected query for empty results: {query}")
         
         # If we've exhausted all retries, make one last attempt
         return query_to_dict(query), query
 
-    def summarize_results(self, question, results, query, company, model):
-        truncated_results = json.dumps([dict(row) for row in results[:10]], indent=4, cls=DecimalEncoder)
-        summary_message = [{
+    def summary_messages(self, question, results):
+        # Truncate before serializing, and keep the JSON compact to save prompt tokens
+        truncated_results = json.dumps(list(islice(results, 10)), separators=(',', ':'), cls=DecimalEncoder)
+        return [{
             "role": "user",
             "content": [{
                 "type": "text",
@@ -233,31 +389,45 @@ class GTFSQueryEngine:
                 """
             }]
         }]
+
+    def summarize_results(self, question, results, query, company, model):
+        summary_message = self.summary_messages(question, results)
         return llm_call(self.summary_system_prompt, summary_message, client_name=company, model=model, max_tokens=100)
 
-    def validate_data(self, summary, results, company, model):
+    def stream_summary(self, question, results, company, model):
+        summary_message = self.summary_messages(question, results)
+        return llm_stream(self.summary_system_prompt, summary_message, client_name=company, model=model, max_tokens=100)
+
+    def validate_data(self, question, results, company, model):
         validation_message = [{
             "role": "user",
             "content": [{
                 "type": "text",
                 "text": f"""
-                    Summary: {summary}
-                    Full data: {json.dumps(results[:20], indent=2, cls=DecimalEncoder)}
+                    Question: {question}
+                    Full data: {json.dumps(list(islice(results, 20)), separators=(',', ':'), cls=DecimalEncoder)}
                 """
             }]
         }]
         return llm_call(self.data_validation_prompt, validation_message, client_name=company, model=model, max_tokens=100)
 
     def process_query(self, messages, company="anthropic", model="claude-3-sonnet-20240229"):
-        query = self.generate_query(messages, company, model)
+        cached = lookup_answer(messages, company, model)
+        if cached:
+            return cached
+
+        query, error_message = self.generate_query(messages, company, model)
         print(f"Generated query: {query}")
         
-        results, final_query = self.execute_query_with_retries(query, company, model)
+        results, final_query = self.execute_query_with_retries(query, company, model, error_message=error_message)
         
         question = messages[-1]['content'][0]['text']
-        summary = self.summarize_results(question, results, final_query, company, model)
-        
-        validation_result = self.validate_data(summary, results, company, model)
+
+        # Summary and validation only depend on the results, so run them concurrently
+        summary_future = LLM_EXECUTOR.submit(self.summarize_results, question, results, final_query, company, model)
+        validation_future = LLM_EXECUTOR.submit(self.validate_data, question, results, company, model)
+        summary = summary_future.result()
+        validation_result = validation_future.result()
         if validation_result.startswith("SUSPICIOUS"):
             print(f"Data flagged as suspicious: {validation_result}")
             corrected_query = self.correct_empty_results(final_query, company, model)
@@ -265,31 +435,60 @@ class GTFSQueryEngine:
             results, final_query = self.execute_query_with_retries(corrected_query, company, model)
             summary = self.summarize_results(question, results, final_query, company, model)
         
+        store_answer(messages, company, model, summary, results, final_query, encoder=DecimalEncoder)
         return summary, results, final_query
 
-def execute_query():
-    query = request.json.get('query')
-    if not query:
-        return jsonify({'error': 'No query provided'}), 400
-    try:
-        results = query_to_dict(query)
-        return jsonify(json.loads(json.dumps(results, cls=DecimalEncoder))), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 400
+    def stream_query(self, messages, company="anthropic", model="claude-3-sonnet-20240229"):
+        """
+        Same pipeline as process_query, but yields events as they become available:
+        a "result" event with the table and query, then "summary" events with text chunks.
+        If validation flags the data, a fresh "result" event replaces the previous answer.
+        """
+        cached = lookup_answer(messages, company, model)
+        if cached:
+            summary, results, final_query = cached
+            yield {"type": "result", "table": results, "query": final_query}
+            yield {"type": "summary", "text": summary}
+            return
+
+        query, error_message = self.generate_query(messages, company, model)
+        print(f"Generated query: {query}")
 
-def chat():
-    messages = request.json.get('messages')
-    company_model = request.json.get('company_model', 'anthropic - claude-3-sonnet-20240229')
-    company, model = company_model.split(' - ')
-    
-    print(f"Received messages: {messages}")
-    print(f"Selected company: {company}, model: {model}")
+        results, final_query = self.execute_query_with_retries(query, company, model, error_message=error_message)
+
+        question = messages[-1]['content'][0]['text']
+        validation_future = LLM_EXECUTOR.submit(self.validate_data, question, results, company, model)
+
+        yield {"type": "result", "table": results, "query": final_query}
+        summary = ''
+        for text in self.stream_summary(question, results, company, model):
+            summary += text
+            yield {"type": "summary", "text": text}
+
+        validation_result = validation_future.result()
+        if validation_result.startswith("SUSPICIOUS"):
+            print(f"Data flagged as suspicious: {validation_result}")
+            corrected_query = self.correct_empty_results(final_query, company, model)
+            print(f"Corrected query for suspicious data: {corrected_query}")
+            results, final_query = self.execute_query_with_retries(corrected_query, company, model)
+
+            yield {"type": "result", "table": results, "query": final_query}
+            summary = ''
+            for text in self.stream_summary(question, results, company, model):
+                summary += text
+                yield {"type": "summary", "text": text}
+
+        store_answer(messages, company, model, summary.strip(), results, final_query, encoder=DecimalEncoder)
+
+# Shared engine, rebuilt after a new feed is uploaded
+_engine = None
 
-    engine = GTFSQueryEngine()
-    summary, results, query = engine.process_query(messages, company, model)
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = GTFSQueryEngine()
+    return _engine
 
-    return jsonify({
-        "summary": summary,
-        "table": json.loads(json.dumps(results, cls=DecimalEncoder)),
-        "query": query
-    }), 200
\ No newline at end of file
+def reset_engine():
+    global _engine
+    _engine = None
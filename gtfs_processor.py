@@ -1,11 +1,14 @@
-import pandas as pd
 from psycopg2 import sql
-from io import StringIO
-from database import get_db_connection, execute_query
-
-import pandas as pd
-import numpy as np
-from datetime import time
+import csv
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from database import db_connection, execute_query, query_to_dict
+from cache import clear_answers
+from pg_copy import BinaryCopyIO
 
 VALID_GTFS_FILES = {
     'agency.txt', 'stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt',
@@ -13,6 +16,24 @@ VALID_GTFS_FILES = {
     'transfers.txt', 'feed_info.txt'
 }
 
+FILE_TO_TABLE = {filename: filename[:-len('.txt')] for filename in VALID_GTFS_FILES}
+
+# (table, column) pairs that GTFS queries commonly join or filter on
+GTFS_JOIN_INDEXES = [
+    ('stop_times', 'trip_id'),
+    ('stop_times', 'stop_id'),
+    ('trips', 'route_id'),
+    ('trips', 'service_id'),
+    ('trips', 'shape_id'),
+    ('routes', 'agency_id'),
+    ('stops', 'parent_station'),
+    ('calendar_dates', 'service_id'),
+    ('shapes', 'shape_id'),
+    ('frequencies', 'trip_id'),
+    ('transfers', 'from_stop_id'),
+    ('transfers', 'to_stop_id')
+]
+
 GTFS_COLUMN_TYPES = {
     'agency': {
         'agency_id': str,
@@ -68,8 +89,8 @@ GTFS_COLUMN_TYPES = {
     },
     'stop_times': {
         'trip_id': str,
-        'arrival_time': str,  # We'll convert this to timedelta later
-        'departure_time': str,  # We'll convert this to timedelta later
+        'arrival_time': str,  # Stored as INTERVAL
+        'departure_time': str,  # Stored as INTERVAL
         'stop_id': str,
         'stop_sequence': int,
         'stop_headsign': str,
@@ -89,12 +110,12 @@ GTFS_COLUMN_TYPES = {
         'friday': int,
         'saturday': int,
         'sunday': int,
-        'start_date': str,  # We'll convert this to datetime later
-        'end_date': str  # We'll convert this to datetime later
+        'start_date': str,  # Stored as DATE
+        'end_date': str  # Stored as DATE
     },
     'calendar_dates': {
         'service_id': str,
-        'date': str,  # We'll convert this to datetime later
+        'date': str,  # Stored as DATE
         'exception_type': int
     },
     'shapes': {
@@ -106,8 +127,8 @@ GTFS_COLUMN_TYPES = {
     },
     'frequencies': {
         'trip_id': str,
-        'start_time': str,  # We'll convert this to timedelta later
-        'end_time': str,  # We'll convert this to timedelta later
+        'start_time': str,  # Stored as INTERVAL
+        'end_time': str,  # Stored as INTERVAL
         'headway_secs': int,
         'exact_times': int
     },
@@ -122,37 +143,62 @@ GTFS_COLUMN_TYPES = {
         'feed_publisher_url': str,
         'feed_lang': str,
         'default_lang': str,
-        'feed_start_date': str,  # We'll convert this to datetime later
-        'feed_end_date': str,  # We'll convert this to datetime later
+        'feed_start_date': str,  # Stored as DATE
+        'feed_end_date': str,  # Stored as DATE
         'feed_version': str,
         'feed_contact_email': str,
         'feed_contact_url': str
     }
 }
 
-def read_gtfs(table_name, file_content):
-    # Read the CSV file
-    df = pd.read_csv(StringIO(file_content), dtype=GTFS_COLUMN_TYPES.get(table_name, {}))
-
-    # Convert time fields to timedelta
-    if table_name == 'stop_times':
-        for col in ['arrival_time', 'departure_time']:
-            df[col] = pd.to_timedelta(df[col])
-    elif table_name == 'frequencies':
-        for col in ['start_time', 'end_time']:
-            df[col] = pd.to_timedelta(df[col])
-
-    # Convert date fields to datetime
-    if table_name in ['calendar', 'calendar_dates', 'feed_info']:
-        date_columns = {
-            'calendar': ['start_date', 'end_date'],
-            'calendar_dates': ['date'],
-            'feed_info': ['feed_start_date', 'feed_end_date']
-        }
-        for col in date_columns.get(table_name, []):
-            df[col] = pd.to_datetime(df[col], format='%Y%m%d')
-
-    return df
+def csv_header(header_line):
+    # Only the header line is decoded; the rest of the file stays as raw bytes
+    header = next(csv.reader([header_line.decode('utf-8-sig')]), [])
+    return [col.strip() for col in header]
+
+def arrow_type(py_type):
+    if py_type == int:
+        return pa.int64()
+    elif py_type == float:
+        return pa.float64()
+    else:
+        return pa.string()
+
+def read_gtfs_arrow(table_name, file, header):
+    # Parse the rest of the stream (after the header line) with Arrow's multithreaded reader,
+    # typing columns at parse time; only pass types for columns the file actually has.
+    # Empty fields, quoted or not, are NULL, matching the CSV COPY options
+    column_types = GTFS_COLUMN_TYPES.get(table_name, {})
+    if not file.peek(1):
+        # Header-only files are common for optional tables, but read_csv rejects empty input
+        return pa.schema([(col, arrow_type(column_types.get(col, str))) for col in header]).empty_table()
+    return pacsv.read_csv(
+        file,
+        read_options=pacsv.ReadOptions(block_size=8 << 20, use_threads=True, column_names=header),
+        convert_options=pacsv.ConvertOptions(
+            column_types={col: arrow_type(column_types[col]) for col in header if col in column_types},
+            strings_can_be_null=True
+        )
+    )
+
+def parse_gtfs_time(array):
+    # GTFS times are H:MM:SS and may run past 24:00:00, so they become durations rather than times of day
+    parts = pc.split_pattern(pc.utf8_trim_whitespace(array), ':')
+    hours, minutes, seconds = (pc.list_element(parts, i).cast(pa.int64()) for i in range(3))
+    total = pc.add(pc.add(pc.multiply(hours, 3600), pc.multiply(minutes, 60)), seconds)
+    return total.cast(pa.duration('s'))
+
+def parse_gtfs_date(array):
+    return pc.strptime(pc.utf8_trim_whitespace(array), format='%Y%m%d', unit='s').cast(pa.date32())
+
+def to_binary_types(table, sql_types):
+    # Binary COPY needs typed values; CSV-loaded tables leave this parsing to Postgres
+    for i, col in enumerate(table.column_names):
+        if sql_types.get(col) == 'INTERVAL':
+            table = table.set_column(i, col, parse_gtfs_time(table.column(col)))
+        elif sql_types.get(col) == 'DATE':
+            table = table.set_column(i, col, parse_gtfs_date(table.column(col)))
+    return table
 
 def infer_sql_type(py_type):
     if py_type == int:
@@ -164,108 +210,275 @@ def infer_sql_type(py_type):
     else:
         return "TEXT"  # Default to TEXT for unknown types
 
-def process_gtfs_file(file_content, filename):
-    if filename not in VALID_GTFS_FILES:
-        raise ValueError(f"Invalid GTFS filename: {filename}")
+# Time and date columns are stored as native Postgres types rather than their parsed Python type
+GTFS_SQL_TYPE_OVERRIDES = {
+    'stop_times': {'arrival_time': 'INTERVAL', 'departure_time': 'INTERVAL'},
+    'frequencies': {'start_time': 'INTERVAL', 'end_time': 'INTERVAL'},
+    'calendar': {'start_date': 'DATE', 'end_date': 'DATE'},
+    'calendar_dates': {'date': 'DATE'},
+    'feed_info': {'feed_start_date': 'DATE', 'feed_end_date': 'DATE'}
+}
 
-    table_name = filename.split('.')[0]
-    df = read_gtfs(table_name, file_content)
-    
-    columns = [
-        sql.SQL("{} {}").format(
-            sql.Identifier(col),
-            sql.SQL(infer_sql_type(df[col].dtype))
-        )
-        for col in df.columns
-    ]
-    
-    create_table_query = sql.SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(
-        sql.Identifier(table_name),
-        sql.SQL(', ').join(columns)
-    )
-    execute_query(create_table_query)
-    
-    conn = get_db_connection()
+GTFS_SQL_TYPES = {
+    table: {
+        col: GTFS_SQL_TYPE_OVERRIDES.get(table, {}).get(col, infer_sql_type(py_type))
+        for col, py_type in cols.items()
+    }
+    for table, cols in GTFS_COLUMN_TYPES.items()
+}
+
+def quote_ident(name):
+    # Same quoting as sql.Identifier, but usable without a connection
+    return '"' + name.replace('"', '""') + '"'
+
+# DDL fragments for the known GTFS tables and columns, built once at import
+GTFS_TABLE_IDENTS = {table: quote_ident(table) for table in GTFS_COLUMN_TYPES}
+GTFS_COLUMN_DDL = {
+    table: {col: f"{quote_ident(col)} {col_type}" for col, col_type in cols.items()}
+    for table, cols in GTFS_SQL_TYPES.items()
+}
+
+# information_schema data_type names for the column types above, to compare against existing tables
+INFORMATION_SCHEMA_TYPES = {
+    'INTEGER': 'integer', 'FLOAT': 'double precision', 'TEXT': 'text',
+    'INTERVAL': 'interval', 'DATE': 'date'
+}
+
+# Stop locations as PostGIS points, computed by Postgres as each row is COPYed
+STOPS_GEOMETRY_DDL = (
+    "geometry geometry(Point, 4326) "
+    "GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(stop_lon, stop_lat), 4326)) STORED"
+)
+STOPS_GEOMETRY_COLUMNS = {'stop_lat', 'stop_lon'}
+
+# Large, mostly numeric tables sent with binary COPY so the server skips text parsing
+BINARY_TABLES = {'shapes', 'stop_times'}
+
+# Bytes copy_expert pulls from a file per read; the 8KB default means many more, smaller COPY messages
+COPY_READ_SIZE = 1 << 20
+
+def prepare_gtfs_file(file, filename):
+    """Parse one file and describe its table; runs off the connection so files can be prepared concurrently."""
+    table_name = FILE_TO_TABLE[filename]
+    # Column order follows the file so COPY lines up; types come from the static GTFS schema
+    sql_types = GTFS_SQL_TYPES[table_name]
     try:
-        with conn.cursor() as cur:
-            buffer = StringIO()
-            df.to_csv(buffer, index=False, header=False, na_rep='\\N')
-            buffer.seek(0)
-            cur.copy_from(buffer, table_name, sep=',', null='\\N')
-        conn.commit()
+        header = csv_header(file.readline())
+        if table_name in BINARY_TABLES:
+            table = to_binary_types(read_gtfs_arrow(table_name, file, header), sql_types)
+            columns = table.column_names
+            buffer = BinaryCopyIO(table, [sql_types.get(col, 'TEXT') for col in columns])
+            copy_options = "FORMAT binary"
+        else:
+            # Stream the rest of the original CSV into COPY as-is; Postgres parses HH:MM:SS as INTERVAL
+            # (including hours past 24) and YYYYMMDD as DATE
+            columns = header
+            buffer = file
+            # NULL '' only covers unquoted empty fields; FORCE_NULL makes quoted "" NULL as well,
+            # as it is on the Arrow path, so fully quoted exports load into typed columns
+            copy_options = "FORMAT csv, HEADER false, NULL '', FORCE_NULL ({})".format(
+                ', '.join(quote_ident(col) for col in columns)
+            )
     except Exception as e:
-        conn.rollback()
         raise Exception(f"Error processing {filename}: {str(e)}")
-    finally:
-        conn.close()
-
-def cleanup_tables():
-    table_names = [file.split('.')[0] for file in VALID_GTFS_FILES]
-    for table in table_names:
-        query = sql.SQL("DROP TABLE IF EXISTS {} CASCADE;").format(sql.Identifier(table))
-        execute_query(query)
-
-def add_spatial_index_to_stops():
-    queries = [
-        "ALTER TABLE stops ADD COLUMN IF NOT EXISTS geometry geometry(Point, 4326);",
-        "UPDATE stops SET geometry = ST_SetSRID(ST_MakePoint(stop_lon::float, stop_lat::float), 4326) WHERE geometry IS NULL;",
-        "CREATE INDEX IF NOT EXISTS stops_geometry_idx ON stops USING GIST (geometry);"
-    ]
-    for query in queries:
-        execute_query(query)
 
-def process_gtfs_feed(feed_content):
-    cleanup_tables()
+    return {
+        'filename': filename,
+        'table_name': table_name,
+        'column_types': [(col, sql_types.get(col, 'TEXT')) for col in columns],
+        'buffer': buffer,
+        'copy_options': copy_options
+    }
 
-    for filename, content in feed_content.items():
-        if filename in VALID_GTFS_FILES:
-            process_gtfs_file(content, filename)
-    
-    if 'stops.txt' in feed_content:
-        add_spatial_index_to_stops()
+def process_gtfs_file(cur, prepared, existing_columns):
+    table = GTFS_TABLE_IDENTS[prepared['table_name']]
+    column_types = prepared['column_types']
+    column_ddl = GTFS_COLUMN_DDL[prepared['table_name']]
+
+    # Columns outside the GTFS spec keep the file's name and are loaded as their fallback type
+    column_defs = [column_ddl.get(col) or f"{quote_ident(col)} {col_type}" for col, col_type in column_types]
+    if prepared['table_name'] == 'stops' and STOPS_GEOMETRY_COLUMNS <= {col for col, _ in column_types}:
+        column_defs.append(STOPS_GEOMETRY_DDL)
+
+    # Tables are UNLOGGED so COPY and index builds skip WAL; a feed lost in a server crash
+    # can simply be uploaded again
+    create_table_query = "CREATE UNLOGGED TABLE IF NOT EXISTS {} ({})".format(table, ', '.join(column_defs))
+    copy_query = "COPY {} ({}) FROM STDIN WITH ({})".format(
+        table,
+        ', '.join(quote_ident(col) for col, _ in column_types),
+        prepared['copy_options']
+    )
+
+    # A table kept from the previous feed is reused only if this file has exactly its columns
+    existing = existing_columns.get(prepared['table_name'])
+    wanted = {col: INFORMATION_SCHEMA_TYPES[col_type] for col, col_type in column_types}
 
-def gtfs_schema():
-    schema_strings = []
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            # Get all tables in the public schema
-            cur.execute("""
-                SELECT table_name 
-                FROM information_schema.tables 
-                WHERE table_schema = 'public'
-            """)
-            tables = [row[0] for row in cur.fetchall()]
-            
-            # Filter for GTFS tables
-            gtfs_tables = [table for table in tables if table in GTFS_COLUMN_TYPES.keys()]
-
-            print(tables, gtfs_tables)
-            
-            for table in gtfs_tables:
-                # Get column information for each table
-                cur.execute(sql.SQL("""
-                    SELECT column_name, data_type, character_maximum_length
-                    FROM information_schema.columns
-                    WHERE table_name = {}
-                    ORDER BY ordinal_position
-                """).format(sql.Literal(table)))
-                
-                columns = cur.fetchall()
-                column_defs = []
-                
-                for col_name, data_type, max_length in columns:
-                    if data_type == 'character varying' and max_length:
-                        col_type = f"VARCHAR({max_length})"
-                    else:
-                        col_type = data_type.upper()
-                    
-                    column_defs.append(f"{col_name} {col_type}")
-                
-                schema = ", ".join(column_defs)
-                schema_strings.append(f"{table} ({schema});")
+        if existing is not None and existing != wanted:
+            cur.execute(f"DROP TABLE {table} CASCADE")
+        cur.execute(create_table_query)
+        cur.copy_expert(copy_query, prepared['buffer'], size=COPY_READ_SIZE)
+    except Exception as e:
+        raise Exception(f"Error processing {prepared['filename']}: {str(e)}")
+
+# Indexes the ingest builds once the data is loaded
+FEED_INDEX_NAMES = ['stops_geometry_idx'] + [f"{table}_{column}_idx" for table, column in GTFS_JOIN_INDEXES]
+
+def existing_gtfs_columns(cur):
+    # Generated columns are not loaded from files, so they are left out of the comparison
+    cur.execute("""
+        SELECT table_name, column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = ANY(%s) AND is_generated = 'NEVER'
+    """, (list(GTFS_COLUMN_TYPES),))
+
+    existing = {}
+    for table, column, data_type in cur.fetchall():
+        existing.setdefault(table, {})[column] = data_type
+    return existing
+
+def cleanup_tables(cur, table_names):
+    """
+    Empty the tables this feed will reload and drop the rest, returning the columns of the
+    kept tables. TRUNCATE keeps the catalog entries, so an unchanged layout is reused; its
+    indexes are dropped and rebuilt once the data is in, which is much cheaper than
+    updating them row by row during COPY (the GIST index on stops especially).
+    """
+    existing = existing_gtfs_columns(cur)
+    kept = [table for table in existing if table in table_names]
+    dropped = [table for table in GTFS_TABLE_IDENTS if table not in kept]
+
+    # One statement each, rather than a round trip per table
+    if kept:
+        cur.execute("TRUNCATE {} RESTART IDENTITY CASCADE".format(', '.join(GTFS_TABLE_IDENTS[table] for table in kept)))
+        cur.execute("DROP INDEX IF EXISTS {}".format(', '.join(quote_ident(index) for index in FEED_INDEX_NAMES)))
+    if dropped:
+        cur.execute("DROP TABLE IF EXISTS {} CASCADE".format(', '.join(GTFS_TABLE_IDENTS[table] for table in dropped)))
+
+    return {table: existing[table] for table in kept}
+
+# Memory for sorting during index builds; the server default (64MB) spills large GTFS tables to disk
+INDEX_BUILD_MEMORY = '256MB'
+
+def add_spatial_index_to_stops(cur):
+    # The geometry column is generated during COPY, so only the index is left to build
+    cur.execute("CREATE INDEX IF NOT EXISTS stops_geometry_idx ON stops USING GIST (geometry);")
+
+def add_join_indexes(cur, loaded_columns):
+    # Index the GTFS foreign keys after the bulk load so generated queries don't scan stop_times
+    for table, column in GTFS_JOIN_INDEXES:
+        if column not in loaded_columns.get(table, ()):
+            continue
+        cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({});").format(
+            sql.Identifier(f"{table}_{column}_idx"),
+            sql.Identifier(table),
+            sql.Identifier(column)
+        ))
+
+    # Refresh planner statistics for the freshly loaded tables only; a bare ANALYZE would
+    # cover every table in the database
+    if loaded_columns:
+        cur.execute("ANALYZE {}".format(', '.join(GTFS_TABLE_IDENTS[table] for table in loaded_columns)))
+
+def load_gtfs_feed(cur, table_names, prepared_files):
+    cur.execute("SET LOCAL synchronous_commit = OFF")
+    cur.execute(f"SET LOCAL maintenance_work_mem = '{INDEX_BUILD_MEMORY}'")
+
+    existing_columns = cleanup_tables(cur, table_names)
+
+    loaded_columns = {}
+    for prepared in prepared_files:
+        process_gtfs_file(cur, prepared, existing_columns)
+        loaded_columns[prepared['table_name']] = [col for col, _ in prepared['column_types']]
     
+    if STOPS_GEOMETRY_COLUMNS <= set(loaded_columns.get('stops', ())):
+        add_spatial_index_to_stops(cur)
+
+    add_join_indexes(cur, loaded_columns)
+
+def process_gtfs_feed(feed_content):
+    # feed_content maps GTFS filenames to binary streams; each is read once, during its COPY
+    global _schema_cache
+    # Non-GTFS members are ignored; everything past this point trusts the filenames
+    filenames = feed_content.keys() & VALID_GTFS_FILES
+    try:
+        # Parse files on worker threads (Arrow releases the GIL) while earlier ones are COPYed
+        with ThreadPoolExecutor(max_workers=max(1, min(len(filenames), os.cpu_count() or 1))) as pool:
+            futures = [pool.submit(prepare_gtfs_file, feed_content[filename], filename) for filename in filenames]
+            prepared_files = (future.result() for future in as_completed(futures))
+
+            # Load the whole feed on one connection in a single transaction, committed once
+            with db_connection() as conn:
+                conn.autocommit = False
+                try:
+                    with conn.cursor() as cur:
+                        load_gtfs_feed(cur, {FILE_TO_TABLE[filename] for filename in filenames}, prepared_files)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.autocommit = True
     finally:
-        conn.close()
-    
-    return '\n'.join(schema_strings)
\ No newline at end of file
+        # The tables changed, so the next gtfs_schema() call has to re-read them
+        # and previously cached answers no longer apply
+        with _schema_lock:
+            _schema_cache = None
+            execute_query("DELETE FROM gtfs_meta WHERE key = 'schema'")
+        clear_answers()
+
+# Schema string built by gtfs_schema(); only changes when a feed is ingested
+_schema_cache = None
+_schema_lock = threading.Lock()
+
+# Rendered schema persisted next to the feed so a restarted app skips the information_schema scan
+GTFS_META_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS gtfs_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+"""
+
+def init_gtfs_meta():
+    execute_query(GTFS_META_TABLE_QUERY)
+
+def gtfs_schema():
+    global _schema_cache
+    if _schema_cache is not None:
+        return _schema_cache
+
+    # Concurrent first requests build the schema once; the rest wait for it
+    with _schema_lock:
+        if _schema_cache is None:
+            _schema_cache = load_gtfs_schema()
+    return _schema_cache
+
+def load_gtfs_schema():
+    rows = query_to_dict("SELECT value FROM gtfs_meta WHERE key = 'schema'")
+    if rows:
+        return rows[0]['value']
+
+    with db_connection() as conn, conn.cursor() as cur:
+        # Column information for every GTFS table present, filtered server-side in one query
+        cur.execute("""
+            SELECT table_name, column_name, data_type, character_maximum_length
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = ANY(%s)
+            ORDER BY table_name, ordinal_position
+        """, (list(GTFS_COLUMN_TYPES),))
+
+        column_defs = {}
+        for table, col_name, data_type, max_length in cur.fetchall():
+            if data_type == 'character varying' and max_length:
+                col_type = f"VARCHAR({max_length})"
+            else:
+                col_type = data_type.upper()
+
+            column_defs.setdefault(table, []).append(f"{col_name} {col_type}")
+
+    schema = '\n'.join(f"{table} ({', '.join(defs)});" for table, defs in column_defs.items())
+    execute_query(
+        "INSERT INTO gtfs_meta (key, value) VALUES ('schema', %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+        (schema,)
+    )
+    return schema
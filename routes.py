@@ -1,14 +1,52 @@
 # routes.py
-from flask import render_template, request, jsonify
+from flask import render_template, request, jsonify, Response
 from werkzeug.utils import secure_filename
 from zipfile import ZipFile
-from io import BytesIO
+from contextlib import ExitStack
 from gtfs_processor import process_gtfs_feed, gtfs_schema, VALID_GTFS_FILES
 from database import query_to_dict
+from queue import Queue, Empty
+import threading
 import traceback
-from engine import GTFSQueryEngine, LLM_CLIENTS
+import json
+from engine import get_engine, reset_engine, LLM_CLIENTS, DecimalEncoder
 
 
+def stream_events(events, heartbeat=15):
+    """
+    Forward events as server-sent event frames. The events are produced on a worker
+    thread; while waiting on it the stream blocks on the queue and sends a keepalive
+    comment every `heartbeat` seconds instead of polling.
+    """
+    event_queue = Queue()
+    done = object()
+
+    def produce():
+        try:
+            for event in events:
+                event_queue.put(event)
+        except Exception as e:
+            traceback.print_exc()
+            event_queue.put({"type": "error", "error": str(e)})
+        finally:
+            event_queue.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        try:
+            event = event_queue.get(timeout=heartbeat)
+        except Empty:
+            yield ": keepalive\n\n"
+            continue
+        if event is done:
+            break
+        yield f"data: {json.dumps(event, cls=DecimalEncoder)}\n\n"
+
+def json_response(data):
+    # Query results can hold Decimal, timedelta and date values that jsonify rejects
+    return Response(json.dumps(data, cls=DecimalEncoder), mimetype='application/json')
+
 def index():
     return render_template('index.html')
 
@@ -25,17 +63,21 @@ def upload_file():
         return jsonify({"error": "File must be a ZIP archive"}), 400
 
     try:
-        zip_contents = {}
-        with ZipFile(BytesIO(file.read())) as zip_file:
-            for filename in zip_file.namelist():
-                if filename in VALID_GTFS_FILES:
-                    with zip_file.open(filename) as file:
-                        zip_contents[filename] = file.read().decode('utf-8')
-        
-        if not zip_contents:
-            return jsonify({"error": "No valid GTFS files found in the ZIP archive"}), 400
+        # The upload is already spooled to a seekable temp file; read members from it directly
+        file.stream.seek(0)
+        with ZipFile(file.stream) as zip_file, ExitStack() as members:
+            # Members are decompressed as the ingest reads them rather than held in memory up front
+            zip_contents = {
+                filename: members.enter_context(zip_file.open(filename))
+                for filename in VALID_GTFS_FILES.intersection(zip_file.namelist())
+            }
+
+            if not zip_contents:
+                return jsonify({"error": "No valid GTFS files found in the ZIP archive"}), 400
+
+            process_gtfs_feed(zip_contents)
 
-        process_gtfs_feed(zip_contents)
+        reset_engine()
         print(f"Processed {len(zip_contents)} GTFS files")
         print(f"Schama:\n{gtfs_schema()}")
         
@@ -51,7 +93,7 @@ def execute_query():
         return jsonify({'error': 'No query provided'}), 400
     try:
         results = query_to_dict(query)
-        return jsonify(results), 200
+        return json_response(results), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
@@ -70,9 +112,15 @@ def chat():
     print(f"Received messages: {messages}")
     print(f"Selected company: {company}, model: {model}")
 
-    engine = GTFSQueryEngine()
+    engine = get_engine()
+
+    if request.json.get('stream'):
+        # Server-sent events: the table first, then the summary as it is generated
+        events = engine.stream_query(messages, company, model)
+        return Response(stream_events(events), mimetype='text/event-stream')
+
     summary, results, query = engine.process_query(messages, company, model)
-    return jsonify({
+    return json_response({
         "summary": summary,
         "table": results,
         "query": query
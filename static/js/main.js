@@ -38,13 +38,18 @@ function showLoadingSpinner() {
     chatMessages.scrollTop = chatMessages.scrollHeight;
 }
 
-function addMessage(message, isUser = false) {
-    messages.push({ message, isUser });
+function appendMessageElement(message, isUser = false) {
     const messageElement = document.createElement('div');
     messageElement.className = `mb-2 p-2 rounded-lg ${isUser ? 'bg-blue-100 text-right' : 'bg-gray-100'}`;
     messageElement.innerHTML = message;
     chatMessages.appendChild(messageElement);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageElement;
+}
+
+function addMessage(message, isUser = false) {
+    messages.push({ message, isUser });
+    return appendMessageElement(message, isUser);
 }
 
 function addErrorMessage(errorText) {
@@ -119,7 +124,8 @@ function executeQuery(query) {
     .then(response => response.json());
 }
 
-function callChatRoute() {
+// Streams the chat answer as server-sent events, calling onEvent for each one
+function callChatRoute(onEvent) {
     const selectedModel = llmModelSelect.value;
     return fetch('/chat', {
         method: 'POST',
@@ -129,10 +135,36 @@ function callChatRoute() {
                 content: [{ type: 'text', text: m.message }], 
                 role: m.isUser ? 'user' : 'assistant'
             })),
-            company_model: selectedModel
+            company_model: selectedModel,
+            stream: true
         })
     })
-    .then(response => response.json());
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(response.statusText);
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        function read() {
+            return reader.read().then(({ done, value }) => {
+                if (done) {
+                    return;
+                }
+                buffer += decoder.decode(value, { stream: true });
+                const frames = buffer.split('\n\n');
+                buffer = frames.pop();
+                frames.forEach(frame => {
+                    if (frame.startsWith('data: ')) {
+                        onEvent(JSON.parse(frame.slice(6)));
+                    }
+                });
+                return read();
+            });
+        }
+        return read();
+    });
 }
 
 // Event Listeners
@@ -179,21 +211,41 @@ sendButton.addEventListener('click', function() {
         userInput.value = '';
         showLoadingSpinner();
         
-        callChatRoute()
-            .then(data => {
+        let summary = '';
+        let summaryElement = null;
+        let tableElement = null;
+
+        callChatRoute(data => {
                 console.log(data);
-                addDebugEntry(JSON.stringify(data, null, 2));
 
-                addMessage(data.summary);
-                
-                const tableElement = createTable(data.table);
-                chatMessages.appendChild(tableElement);
-                
-                chatMessages.scrollTop = chatMessages.scrollHeight;
+                if (data.type === 'result') {
+                    addDebugEntry(JSON.stringify(data, null, 2));
+
+                    // A repeated result event replaces the previous answer
+                    if (summaryElement) {
+                        summaryElement.remove();
+                        tableElement.remove();
+                    }
+                    summary = '';
+                    summaryElement = appendMessageElement(summary);
 
-                if (data.query) {
-                    queryInput.value = data.query;
+                    tableElement = createTable(data.table);
+                    chatMessages.appendChild(tableElement);
+
+                    if (data.query) {
+                        queryInput.value = data.query;
+                    }
+                } else if (data.type === 'summary') {
+                    summary += data.text;
+                    summaryElement.innerHTML = summary;
+                } else if (data.type === 'error') {
+                    throw new Error(data.error);
                 }
+
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            })
+            .then(() => {
+                messages.push({ message: summary, isUser: false });
             })
             .catch(error => {
                 console.error('Error:', error);